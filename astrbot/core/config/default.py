@@ -47,6 +47,7 @@ DEFAULT_CONFIG = {
         "datetime_system_prompt": True,
         "default_personality": "default",
         "prompt_prefix": "",
+        "max_context_length": -1,
     },
     "provider_stt_settings": {
         "enable": False,
@@ -610,6 +611,22 @@ CONFIG_METADATA_2 = {
                         "type": "int",
                         "hint": "超时时间，单位为秒。",
                     },
+                    "http_backend": {
+                        "description": "HTTP 后端",
+                        "type": "string",
+                        "hint": "OpenAI API Chat Completion 提供商适配器使用的 HTTP 后端。默认为 aiohttp，在并发请求较多时性能更好。如果遇到兼容性问题，可以切换为 httpx。",
+                        "options": ["aiohttp", "httpx"],
+                    },
+                    "direct_http": {
+                        "description": "直接请求 API",
+                        "type": "bool",
+                        "hint": "启用后，OpenAI API Chat Completion 提供商适配器在不使用函数调用工具时会直接使用 aiohttp 请求 /chat/completions 接口，跳过 OpenAI SDK 的额外开销。仅在连接失败（未收到响应）或响应无法解析时改用 SDK 重新请求，API 返回的错误会直接报告。模型配置中包含 extra_body、extra_headers、extra_query 或 timeout 时仍使用 SDK 请求。不支持 Azure OpenAI。",
+                    },
+                    "context_window": {
+                        "description": "上下文窗口大小",
+                        "type": "int",
+                        "hint": "模型的上下文窗口大小(token)。填写后，OpenAI API Chat Completion 提供商适配器会在请求前估算 token 数并裁剪最早的对话记录，避免超出上下文长度。需要安装 tiktoken。不填写时，仅对部分已知的 OpenAI 模型生效。",
+                    },
                     "openai-tts-voice": {
                         "description": "voice",
                         "type": "string",
@@ -776,6 +793,11 @@ CONFIG_METADATA_2 = {
                         "type": "string",
                         "hint": "添加之后，会在每次对话的 Prompt 前加上此文本。",
                     },
+                    "max_context_length": {
+                        "description": "最多携带对话数量(条)",
+                        "type": "int",
+                        "hint": "请求 LLM 时最多携带的最近对话轮数（一问一答为一轮），超出的部分不会发送给模型，但仍会保存在对话记录中。-1 为不限制。",
+                    },
                 },
             },
             "persona": {
@@ -1,7 +1,8 @@
 import uuid
-import json
 import asyncio
-from astrbot.core import sp
+import itertools
+import orjson
+from astrbot.core import sp, logger
 from typing import Dict, List
 from astrbot.core.db import BaseDatabase
 from astrbot.core.db.po import Conversation
@@ -13,6 +14,13 @@ class ConversationManager():
         self.db = db_helper
         self.save_interval = 60  # 每 60 秒保存一次
         self._start_periodic_save()
+        self.history_flush_delay = 1  # 对话历史更新后延迟 1 秒写入，合并这段时间内的多次更新
+        self._pending_histories: Dict[str, tuple] = {}
+        '''待写入数据库的对话历史。key: conversation_id, value: (unified_msg_origin, history)'''
+        self._writing: str = None
+        '''正在写入数据库的对话 ID'''
+        self._flush_now = asyncio.Event()
+        self._flush_task: asyncio.Task = None
                 
     def _start_periodic_save(self):
         asyncio.create_task(self._periodic_save())
@@ -25,6 +33,43 @@ class ConversationManager():
     def _save_to_storage(self):
         sp.put("session_conversation", self.session_conversations)
 
+    async def _flush_histories(self):
+        '''
+        在后台将待写入的对话历史写入数据库。等待 history_flush_delay 秒（或者 flush() 被调用）后再写入，
+        同一对话在这段时间内多次更新时只写入最新的一次。数据库写入在线程中执行，不阻塞事件循环。
+        '''
+        try:
+            await asyncio.wait_for(self._flush_now.wait(), self.history_flush_delay)
+        except asyncio.TimeoutError:
+            pass
+        while self._pending_histories:
+            conversation_id, (unified_msg_origin, history) = self._pending_histories.popitem()
+            self._writing = conversation_id
+            try:
+                # 在事件循环中序列化，history 可能在写入期间被其他协程修改
+                history_str = orjson.dumps(history).decode('utf-8')
+                await asyncio.to_thread(
+                    self.db.update_conversation,
+                    user_id=unified_msg_origin,
+                    cid=conversation_id,
+                    history=history_str
+                )
+            except Exception as e:
+                logger.error(f"保存对话 {conversation_id} 的历史记录失败：{e}")
+            finally:
+                self._writing = None
+
+    async def flush(self):
+        '''立即将所有待写入的对话历史写入数据库，并等待写入完成'''
+        if self._flush_task and not self._flush_task.done():
+            self._flush_now.set()
+            await asyncio.shield(self._flush_task)
+
+    async def _wait_for_write(self, conversation_id: str):
+        '''对话有尚未写入数据库的历史记录时，等待写入完成'''
+        if conversation_id in self._pending_histories or conversation_id == self._writing:
+            await self.flush()
+
     async def new_conversation(self, unified_msg_origin: str) -> str:
         '''新建对话，并将当前会话的对话转移到新对话'''
         conversation_id = str(uuid.uuid4())
@@ -45,6 +90,8 @@ class ConversationManager():
         '''删除会话的对话，当 conversation_id 为 None 时删除会话当前的对话'''
         conversation_id = self.session_conversations.get(unified_msg_origin)
         if conversation_id:
+            self._pending_histories.pop(conversation_id, None)
+            await self._wait_for_write(conversation_id)
             self.db.delete_conversation(
                 user_id=unified_msg_origin,
                 cid=conversation_id
@@ -58,20 +105,21 @@ class ConversationManager():
     
     async def get_conversation(self, unified_msg_origin: str, conversation_id: str) -> Conversation:
         '''获取会话的对话'''
+        await self._wait_for_write(conversation_id)
         return self.db.get_conversation_by_user_id(unified_msg_origin, conversation_id)
     
     async def get_conversations(self, unified_msg_origin: str) -> List[Conversation]:
         '''获取会话的所有对话'''
+        await self.flush()
         return self.db.get_conversations(unified_msg_origin)
     
     async def update_conversation(self, unified_msg_origin: str, conversation_id: str, history: List[Dict]):
-        '''更新会话的对话'''
+        '''更新会话的对话。历史记录会在后台写入数据库，不阻塞调用方。'''
         if conversation_id:
-            self.db.update_conversation(
-                user_id=unified_msg_origin,
-                cid=conversation_id,
-                history=json.dumps(history)
-            )
+            self._pending_histories[conversation_id] = (unified_msg_origin, history)
+            if not self._flush_task or self._flush_task.done():
+                self._flush_now.clear()
+                self._flush_task = asyncio.create_task(self._flush_histories())
             
     async def update_conversation_title(self, unified_msg_origin: str, title: str):
         '''更新会话的对话标题'''
@@ -95,7 +143,7 @@ class ConversationManager():
             
     async def get_human_readable_context(self, unified_msg_origin, conversation_id, page=1, page_size=10):
         conversation = await self.get_conversation(unified_msg_origin, conversation_id)
-        history = json.loads(conversation.history)
+        history = orjson.loads(conversation.history)
 
         contexts = []
         temp_contexts = []
@@ -104,16 +152,16 @@ class ConversationManager():
                 temp_contexts.append(f"User: {record['content']}")
             elif record['role'] == "assistant":
                 temp_contexts.append(f"Assistant: {record['content']}")
-                contexts.insert(0, temp_contexts)
+                contexts.append(temp_contexts)
                 temp_contexts = []
 
-        # 展平 contexts 列表
-        contexts = [item for sublist in contexts for item in sublist]
+        # 最新的对话在前，展平 contexts 列表
+        contexts = list(itertools.chain.from_iterable(reversed(contexts)))
 
         # 计算分页
         paged_contexts = contexts[(page-1)*page_size:page*page_size]
-        total_pages = len(contexts) // page_size
-        if len(contexts) % page_size != 0:
+        total_pages, remainder = divmod(len(contexts), page_size)
+        if remainder:
             total_pages += 1
         
         return paged_contexts, total_pages
\ No newline at end of file
@@ -112,6 +112,7 @@ class AstrBotCoreLifecycle:
             task.cancel()
             
         await self.provider_manager.terminate()
+        await self.conversation_manager.flush()
         
         for task in self.curr_tasks:
             try:
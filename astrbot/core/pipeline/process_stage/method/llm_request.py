@@ -2,7 +2,7 @@
 本地 Agent 模式的 LLM 调用 Stage
 '''
 import traceback
-import json
+import orjson
 from typing import Union, AsyncGenerator
 from ...context import PipelineContext
 from ..stage import Stage
@@ -26,6 +26,8 @@ class LLMRequestSubStage(Stage):
             if self.provider_wake_prefix.startswith(bwp):
                 logger.info(f"识别 LLM 聊天额外唤醒前缀 {self.provider_wake_prefix} 以机器人唤醒前缀 {bwp} 开头，已自动去除。")
                 self.provider_wake_prefix = self.provider_wake_prefix[len(bwp):]
+        
+        self.max_context_length = ctx.astrbot_config['provider_settings'].get('max_context_length', -1)
                 
         self.conv_manager = ctx.plugin_manager.context.conversation_manager
         
@@ -58,7 +60,7 @@ class LLMRequestSubStage(Stage):
             req.session_id = event.unified_msg_origin
             conversation = await self.conv_manager.get_conversation(event.unified_msg_origin, conversation_id)
             req.conversation = conversation
-            req.contexts = json.loads(conversation.history)
+            req.contexts = orjson.loads(conversation.history)
 
             event.set_extra("provider_request", req)
             
@@ -76,13 +78,16 @@ class LLMRequestSubStage(Stage):
                 logger.error(traceback.format_exc())
                 
         if isinstance(req.contexts, str):
-            req.contexts = json.loads(req.contexts)
+            req.contexts = orjson.loads(req.contexts)
         
         try:
             logger.debug(f"提供商请求 Payload: {req}")
             if _nested:
                 req.func_tool = None # 暂时不支持递归工具调用
-            llm_response = await provider.text_chat(**req.__dict__) # 请求 LLM
+            llm_response = await provider.text_chat(**{
+                **req.__dict__,
+                "contexts": self._truncate_contexts(req.contexts)
+            }) # 请求 LLM
             
             # 执行 LLM 响应后的事件钩子。
             handlers = star_handlers_registry.get_handlers_by_event_type(EventType.OnLLMResponseEvent)
@@ -141,6 +146,18 @@ class LLMRequestSubStage(Stage):
             event.set_result(MessageEventResult().message(f"AstrBot 请求失败。\n错误类型: {type(e).__name__}\n错误信息: {str(e)}"))
             return
         
+    def _truncate_contexts(self, contexts: list) -> list:
+        '''按照 max_context_length 只保留最近的若干轮对话。开头的人格预设对话不计入且始终保留。'''
+        if not contexts or self.max_context_length <= 0:
+            return contexts
+        keep = self.max_context_length * 2
+        preset_cnt = 0
+        while preset_cnt < len(contexts) and '_no_save' in contexts[preset_cnt]:
+            preset_cnt += 1
+        if len(contexts) - preset_cnt <= keep:
+            return contexts
+        return contexts[:preset_cnt] + contexts[-keep:]
+        
     async def _save_to_history(self, event: AstrMessageEvent, req: ProviderRequest, llm_response: LLMResponse):
         if llm_response.role == "assistant":
             # 文本回复
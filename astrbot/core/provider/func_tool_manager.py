@@ -31,6 +31,16 @@ SUPPORTED_TYPES = [
 class FuncCall:
     def __init__(self) -> None:
         self.func_list: List[FuncTool] = []
+        self._version = 0
+        '''工具列表的版本号，每次增删工具时递增'''
+        self._fndesc_cache = None
+        '''(缓存键, OpenAI API 风格的工具描述)'''
+        self._by_name_cache = None
+        '''(版本号, 工具名到工具的映射)'''
+
+    @property
+    def version(self) -> int:
+        return self._version
 
     def empty(self) -> bool:
         return len(self.func_list) == 0
@@ -66,21 +76,31 @@ class FuncCall:
             handler=handler,
         )
         self.func_list.append(_func)
+        self._version += 1
 
     def remove_func(self, name: str) -> None:
         """
         删除一个函数调用工具。
         """
         for i, f in enumerate(self.func_list):
-            if f["name"] == name:
+            if f.name == name:
                 self.func_list.pop(i)
+                self._version += 1
                 break
 
     def get_func(self, name) -> FuncTool:
-        for f in self.func_list:
-            if f.name == name:
-                return f
-        return None
+        return self.get_func_map().get(name)
+
+    def get_func_map(self) -> Dict[str, FuncTool]:
+        """
+        获得工具名到工具的映射。工具列表未变化时返回缓存的结果，调用方不应修改返回值。
+        """
+        if self._by_name_cache is None or self._by_name_cache[0] != self._version:
+            by_name = {}
+            for f in self.func_list:
+                by_name.setdefault(f.name, f) # 与按顺序查找的行为保持一致，重名时取第一个
+            self._by_name_cache = (self._version, by_name)
+        return self._by_name_cache[1]
 
     def get_func_desc_openai_style(self) -> list:
         """
@@ -101,6 +121,15 @@ class FuncCall:
                 }
             )
         return _l
+
+    def get_func_desc_openai_style_cached(self) -> list:
+        """
+        获得 OpenAI API 风格的**已经激活**的工具描述。工具列表或者激活状态未变化时返回缓存的结果，调用方不应修改返回值。
+        """
+        key = (self._version, tuple(f.active for f in self.func_list))
+        if self._fndesc_cache is None or self._fndesc_cache[0] != key:
+            self._fndesc_cache = (key, self.get_func_desc_openai_style())
+        return self._fndesc_cache[1]
     
     def get_func_desc_anthropic_style(self) -> list:
         """
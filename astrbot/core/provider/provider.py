@@ -1,5 +1,6 @@
 import abc
 import json
+import itertools
 from collections import defaultdict
 from typing import List
 from astrbot.core.db import BaseDatabase
@@ -113,19 +114,15 @@ class Provider(AbstractProvider):
         '''
         弹出 context 第一条非系统提示词对话记录
         '''
-        poped = 0
-        indexs_to_pop = []
-        for idx, record in enumerate(context):
-            if record["role"] == "system":
-                continue
-            else:
-                indexs_to_pop.append(idx)
-                poped += 1
-                if poped == 2:
-                    break
-                
-        for idx in reversed(indexs_to_pop):
-            context.pop(idx)
+        indexs_to_pop = list(itertools.islice(
+            (idx for idx, record in enumerate(context) if record["role"] != "system"), 2
+        ))
+        if len(indexs_to_pop) == 2 and indexs_to_pop[1] == indexs_to_pop[0] + 1:
+            # 通常两条记录是相邻的，用一次切片删除，只需移动一次后面的元素
+            del context[indexs_to_pop[0]:indexs_to_pop[1] + 1]
+        else:
+            for idx in reversed(indexs_to_pop):
+                del context[idx]
 
         
 class STTProvider(AbstractProvider):
@@ -42,6 +42,12 @@ class ProviderAnthropic(ProviderOpenAIOfficial):
         
         self.set_model(provider_config['model_config']['model'])
 
+    def set_key(self, key):
+        self.client.api_key = key
+
+    async def terminate(self):
+        await self.client.close()
+
     async def _query(self, payloads: dict, tools: FuncCall) -> LLMResponse:
         if tools:
             tool_list = tools.get_func_desc_anthropic_style()
@@ -1,20 +1,171 @@
 import base64
-import json
 import os
+import asyncio
+import random
+import time
+import re
+import orjson
+import aiohttp
 
+from collections import OrderedDict
 from openai import AsyncOpenAI, AsyncAzureOpenAI
-from openai.types.chat.chat_completion import ChatCompletion
-from openai._exceptions import NotFoundError, UnprocessableEntityError
+from openai.types.chat.chat_completion import ChatCompletion, Choice
+from openai.types.chat import ChatCompletionMessage, ChatCompletionMessageToolCall
+from openai.types.chat.chat_completion_message_tool_call import Function
+from openai._exceptions import NotFoundError, UnprocessableEntityError, RateLimitError, APIConnectionError, BadRequestError, APITimeoutError, InternalServerError
 from astrbot.core.utils.io import download_image_by_url
 
 from astrbot.core.db import BaseDatabase
 from astrbot.api.provider import Provider, Personality
 from astrbot import logger
 from astrbot.core.provider.func_tool_manager import FuncCall
-from typing import List
+from typing import Dict, List, AsyncGenerator, Awaitable, Callable, Union
 from ..register import register_provider_adapter
 from astrbot.core.provider.entites import LLMResponse
 
+try:
+    import httpx
+except ImportError:
+    # 部分 openai 发行版依赖的是 httpx2
+    import httpx2 as httpx
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+    "gpt-4.5": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-vision-preview": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-3.5-turbo": 16385,
+    "o1": 200000,
+    "o1-mini": 128000,
+    "o1-preview": 128000,
+    "o3": 200000,
+    "o3-mini": 200000,
+    "o4-mini": 200000,
+}
+'''
+常见模型的上下文窗口大小（token）。模型名与 key 完全相同，或者以 key + "-" 开头（如带日期的版本）时匹配，取最长的 key。
+'''
+
+MODEL_CONTEXT_WINDOWS_EXACT = {
+    "gpt-4": 8192,
+    "gpt-4-0613": 8192,
+    "gpt-4-0314": 8192,
+}
+'''只按模型名完全匹配的上下文窗口大小。gpt-4 的后续模型窗口大得多，不能按前缀匹配'''
+
+RETRY_MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 30
+RETRY_JITTER = 0.5
+'''限流、服务端错误（5xx）、连接错误时的指数退避重试参数（秒）'''
+
+_FC_UNSUPPORTED = re.compile(
+    r"does not support (function calling|tools)"
+    r"|function call(ing)? is not (supported|enabled)"
+    r"|tool calling is not supported"
+    r"|no endpoints found that support tool use",
+    re.I
+)
+'''模型不支持函数调用时各家 API 返回的错误提示'''
+
+_SDK_ONLY_PARAMS = frozenset(("extra_body", "extra_headers", "extra_query", "timeout"))
+'''只有 OpenAI SDK 能处理的请求参数。model_config 中包含这些参数时不使用直接请求'''
+
+PREFIX_B64 = "base64://"
+PREFIX_FILE = "file:///"
+
+_ENCODING_CACHE: Dict[str, object] = {}
+'''进程内共享的 tiktoken 编码。key: 模型名, value: tiktoken.Encoding，加载失败时为 None'''
+
+_CLIENT_POOL: Dict[tuple, list] = {}
+'''
+共享的 OpenAI 客户端。指向同一个端点的 Provider 共用一个连接池。
+key: (is_azure, base_url, api_version, timeout, http_backend), value: [客户端, 引用计数]
+'''
+
+
+class _ImageCache():
+    '''按总字节数限制大小的 LRU 缓存，缓存图片编码后的 base64 data url 以及图片 URL 下载后的本地路径。'''
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_urls: int = 256) -> None:
+        self.max_bytes = max_bytes
+        self.max_urls = max_urls
+        self._data: OrderedDict = OrderedDict()
+        '''key: (path, mtime, size), value: data url'''
+        self._bytes = 0
+        self._url_paths: OrderedDict = OrderedDict()
+        '''key: 图片 URL, value: 下载后的本地路径'''
+
+    def get_data(self, key: tuple) -> str:
+        data = self._data.get(key)
+        if data is not None:
+            self._data.move_to_end(key)
+        return data
+
+    def put_data(self, key: tuple, data: str):
+        if len(data) > self.max_bytes:
+            return
+        if key in self._data:
+            self._bytes -= len(self._data.pop(key))
+        self._data[key] = data
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get_path(self, url: str) -> str:
+        path = self._url_paths.get(url)
+        if path is None:
+            return None
+        if not os.path.exists(path):
+            # 临时文件可能已经被清理
+            del self._url_paths[url]
+            return None
+        self._url_paths.move_to_end(url)
+        return path
+
+    def put_path(self, url: str, path: str):
+        self._url_paths[url] = path
+        self._url_paths.move_to_end(url)
+        while len(self._url_paths) > self.max_urls:
+            self._url_paths.popitem(last=False)
+
+
+_image_cache = _ImageCache()
+
+
+def _is_context_length_exceeded(e: Exception, low: str) -> bool:
+    '''判断是否为上下文长度超限错误。low 为小写后的错误信息'''
+    if isinstance(e, BadRequestError) and getattr(e, 'code', None) == 'context_length_exceeded':
+        return True
+    return "maximum context length" in low
+
+
+def _guess_image_mime(header: bytes) -> str:
+    '''根据文件头判断图片的 MIME 类型，无法识别时返回 image/jpeg'''
+    if header.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if header.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if header.startswith(b"RIFF") and header[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg"
+
+
+def _read_and_b64(path: str) -> str:
+    '''读取图片并编码为 base64 data url。该函数会阻塞，应在线程中执行。'''
+    with open(path, "rb") as f:
+        raw = f.read()
+    return f"data:{_guess_image_mime(raw[:12])};base64," + base64.b64encode(raw).decode('ascii')
+
+
 @register_provider_adapter("openai_chat_completion", "OpenAI API Chat Completion 提供商适配器")
 class ProviderOpenAIOfficial(Provider):
     def __init__(
@@ -33,25 +184,184 @@ class ProviderOpenAIOfficial(Provider):
         if isinstance(self.timeout, str):
             self.timeout = int(self.timeout)
         # 适配 azure openai #332
+        self._pool_key = (
+            "api_version" in provider_config,
+            provider_config.get("api_base", None),
+            provider_config.get("api_version", None),
+            self.timeout,
+            provider_config.get("http_backend", "aiohttp")
+        )
+        if self._pool_key not in _CLIENT_POOL:
+            _CLIENT_POOL[self._pool_key] = [self._make_client(provider_config), 0]
+        _CLIENT_POOL[self._pool_key][1] += 1
+        self._shared_client: AsyncOpenAI = _CLIENT_POOL[self._pool_key][0]
+        # with_options 得到的客户端与共享客户端共用连接池
+        self.client = self._shared_client.with_options(api_key=self.chosen_api_key)
+        self._key_idx = 0
+        '''当前使用的 Key 在 api_keys 中的下标'''
+        self._key_available_at: List[float] = [0.0] * len(self.api_keys)
+        '''每个 Key 被限流后可以再次使用的时间戳'''
+
+        self.direct_http = provider_config.get("direct_http", False) and "api_version" not in provider_config
+        '''不经过 OpenAI SDK，直接使用 aiohttp 请求 /chat/completions。仅用于非 Azure、不带工具、不含 SDK 专用参数的非流式请求'''
+        self._aio_session: aiohttp.ClientSession = None
+        self._encoding_task: asyncio.Task = None
+        
+        model_config = provider_config.get("model_config", {})
+        model = model_config.get("model", "unknown")
+        self.set_model(model)
+
+    def set_model(self, model_name: str):
+        super().set_model(model_name)
+        self._context_window = self._get_context_window(model_name)
+        self._encoding = None
+        '''tiktoken 编码，在首次请求时由 _start_encoding_load 在后台加载'''
+
+    def _get_context_window(self, model_name: str) -> int:
+        '''获取模型的上下文窗口大小，优先使用配置中的 context_window。未知时返回 0'''
+        context_window = self.provider_config.get("context_window", 0)
+        if context_window:
+            return int(context_window)
+        if model_name in MODEL_CONTEXT_WINDOWS_EXACT:
+            return MODEL_CONTEXT_WINDOWS_EXACT[model_name]
+        matched = ""
+        for name in MODEL_CONTEXT_WINDOWS:
+            if (model_name == name or model_name.startswith(name + "-")) and len(name) > len(matched):
+                matched = name
+        return MODEL_CONTEXT_WINDOWS.get(matched, 0)
+
+    def _start_encoding_load(self):
+        '''
+        在后台线程中加载当前模型的 tiktoken 编码。tiktoken 可能需要联网下载 BPE 文件，不能阻塞事件循环，
+        也不让请求等待加载完成，加载完成前不在请求前裁剪上下文。
+        '''
+        if self._encoding is not None or not self._context_window or not tiktoken:
+            return
+        model_name = self.get_model()
+        if model_name in _ENCODING_CACHE:
+            self._encoding = _ENCODING_CACHE[model_name]
+            return
+        if self._encoding_task and not self._encoding_task.done():
+            return
+        self._encoding_task = asyncio.create_task(self._load_encoding_in_thread(model_name))
+
+    async def _load_encoding_in_thread(self, model_name: str):
+        encoding = await asyncio.to_thread(self._load_encoding, model_name)
+        if model_name == self.get_model():
+            self._encoding = encoding
+
+    def _load_encoding(self, model_name: str):
+        '''加载模型对应的 tiktoken 编码，同一进程内每个模型只加载一次（包括加载失败的情况）。该函数会阻塞，应在线程中执行。'''
+        if not tiktoken:
+            return None
+        if model_name in _ENCODING_CACHE:
+            return _ENCODING_CACHE[model_name]
+        try:
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"加载 tiktoken 编码失败，将不会在请求前裁剪上下文：{e}")
+            encoding = None
+        _ENCODING_CACHE[model_name] = encoding
+        return encoding
+
+    def _count_tokens(self, messages: List[dict]) -> List[int]:
+        '''估算每条消息的 token 数'''
+        texts = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, list):
+                content = "".join(part.get("text", "") for part in content if isinstance(part, dict))
+            elif not isinstance(content, str):
+                content = ""
+            texts.append(content)
+        # 每条消息额外计入 4 个 token 的格式开销。消息中出现的 <|endoftext|> 等特殊 token 按普通文本计数，
+        # 否则 tiktoken 默认会抛出 ValueError
+        return [len(tokens) + 4 for tokens in self._encoding.encode_batch(texts, disallowed_special=())]
+
+    def _fit_to_window(self, messages: List[dict], max_completion_tokens: int = 0):
+        '''
+        在请求前按照模型的上下文窗口估算 token 数，从最早的对话开始成对弹出记录，直到能够放入窗口。
+        系统提示词和最后一条消息始终保留。会直接修改 messages。
+        '''
+        if not self._context_window or not self._encoding:
+            return
+        budget = self._context_window - max_completion_tokens
+        try:
+            counts = self._count_tokens(messages)
+        except Exception as e:
+            # 估算失败时只是不裁剪，交给请求失败后的上下文超限处理
+            logger.warning(f"估算上下文 token 数失败，跳过请求前裁剪：{e}")
+            return
+        total = sum(counts)
+        if total <= budget:
+            return
+        start = 0
+        while start < len(messages) and messages[start]["role"] == "system":
+            start += 1
+        end = start
+        while total > budget and end + 2 < len(messages):
+            total -= counts[end] + counts[end + 1]
+            end += 2
+        if end > start:
+            logger.info(f"估算上下文长度超过限制，已弹出最早的 {end - start} 条记录。")
+            del messages[start:end]
+
+    def _make_client(self, provider_config: dict) -> AsyncOpenAI:
+        '''
+        构造共享的 SDK 客户端。重试统一由 _query_with_retry 负责，因此关闭 SDK 自带的重试（max_retries=0），
+        否则两层重试会叠加成数倍的请求。
+        '''
+        http_client = self._build_http_client(provider_config.get("http_backend", "aiohttp"))
         if "api_version" in provider_config:
             # 使用 azure api
-            self.client = AsyncAzureOpenAI(
+            return AsyncAzureOpenAI(
                 api_key=self.chosen_api_key,
                 api_version=provider_config.get("api_version", None),
                 base_url=provider_config.get("api_base", None),
-                timeout=self.timeout
+                timeout=self.timeout,
+                max_retries=0,
+                http_client=http_client
             )
-        else:
-            # 使用 openai api
-            self.client = AsyncOpenAI(
-                api_key=self.chosen_api_key,
-                base_url=provider_config.get("api_base", None),
-                timeout=self.timeout
-            )
-        
-        model_config = provider_config.get("model_config", {})
-        model = model_config.get("model", "unknown")
-        self.set_model(model)
+        # 使用 openai api
+        return AsyncOpenAI(
+            api_key=self.chosen_api_key,
+            base_url=provider_config.get("api_base", None),
+            timeout=self.timeout,
+            max_retries=0,
+            http_client=http_client
+        )
+
+    def _build_http_client(self, http_backend: str):
+        '''
+        构造 OpenAI SDK 使用的 HTTP 客户端。aiohttp 在高并发下的表现明显优于默认的 httpx。
+        返回 None 时使用 SDK 默认的 httpx 客户端。
+        '''
+        if http_backend != "aiohttp":
+            return None
+        try:
+            from openai import DefaultAioHttpClient
+            return DefaultAioHttpClient(timeout=self.timeout)
+        except (ImportError, RuntimeError) as e:
+            # 旧版本 SDK 或者未安装 openai[aiohttp]
+            logger.warning(f"无法使用 aiohttp 作为 HTTP 后端，将回退到 httpx：{e}")
+            return None
+
+    async def terminate(self):
+        if self._encoding_task:
+            self._encoding_task.cancel()
+        if self._aio_session and not self._aio_session.closed:
+            await self._aio_session.close()
+        entry = _CLIENT_POOL.get(self._pool_key)
+        if not entry or entry[0] is not self._shared_client:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            # 没有 Provider 再使用这个客户端，关闭连接池
+            del _CLIENT_POOL[self._pool_key]
+            await self._shared_client.close()
 
     async def get_models(self):
         try:
@@ -66,14 +376,18 @@ class ProviderOpenAIOfficial(Provider):
     
     async def _query(self, payloads: dict, tools: FuncCall) -> LLMResponse:
         if tools:
-            tool_list = tools.get_func_desc_openai_style()
+            tool_list = tools.get_func_desc_openai_style_cached()
             if tool_list:
                 payloads['tools'] = tool_list
         
-        completion = await self.client.chat.completions.create(
-            **payloads,
-            stream=False
-        )
+        completion = None
+        if self.direct_http and 'tools' not in payloads and _SDK_ONLY_PARAMS.isdisjoint(payloads):
+            completion = await self._create_completion_direct(payloads)
+        if completion is None:
+            completion = await self.client.chat.completions.create(
+                **payloads,
+                stream=False
+            )
 
         assert isinstance(completion, ChatCompletion)
         logger.debug(f"completion: {completion}")
@@ -91,17 +405,11 @@ class ProviderOpenAIOfficial(Provider):
         
         if choice.message.tool_calls:
             # tools call (function calling)
-            args_ls = []
-            func_name_ls = []
-            for tool_call in choice.message.tool_calls:
-                for tool in tools.func_list:
-                    if tool.name == tool_call.function.name:
-                        args = json.loads(tool_call.function.arguments)
-                        args_ls.append(args)
-                        func_name_ls.append(tool_call.function.name)
-            llm_response.role = "tool"
-            llm_response.tools_call_args = args_ls
-            llm_response.tools_call_name = func_name_ls
+            self._fill_tool_calls(
+                llm_response, 
+                tools, 
+                [(tool_call.function.name, tool_call.function.arguments) for tool_call in choice.message.tool_calls]
+            )
             
         if choice.finish_reason == 'content_filter':
             raise Exception("API 返回的 completion 由于内容安全过滤被拒绝(非 AstrBot)。")
@@ -114,6 +422,250 @@ class ProviderOpenAIOfficial(Provider):
         
         return llm_response
 
+    async def _create_completion_direct(self, payloads: dict) -> ChatCompletion:
+        '''
+        直接使用 aiohttp 请求 /chat/completions，跳过 OpenAI SDK 的请求构造和响应解析开销。
+        只有在收到响应之前连接失败，或者 2xx 响应无法解析时返回 None，由调用方改用 SDK 重新请求。
+        超时、收到响应之后的连接错误以及非 2xx 响应会抛出与 SDK 相同类型的异常，交给调用方的重试和上下文超限处理。
+        '''
+        if self._aio_session is None or self._aio_session.closed:
+            # 复用同一个 session 的连接池，不要每次请求都新建 session
+            self._aio_session = aiohttp.ClientSession(trust_env=True)
+        url = str(self.client.base_url).rstrip("/") + "/chat/completions"
+        headers = {k: v for k, v in self.client.default_headers.items() if isinstance(v, str)}
+        headers["Authorization"] = f"Bearer {self.client.api_key}"
+        headers["Content-Type"] = "application/json"
+        request = httpx.Request("POST", url)
+        responded = False
+        try:
+            async with self._aio_session.post(
+                url,
+                data=orjson.dumps(payloads),
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as resp:
+                responded = True
+                body = await resp.read()
+        except asyncio.TimeoutError as e:
+            raise APITimeoutError(request=request) from e
+        except aiohttp.ClientError as e:
+            if responded:
+                raise APIConnectionError(request=request) from e
+            logger.debug(f"直接请求 {url} 失败：{e}，改用 OpenAI SDK 请求。")
+            return None
+
+        if resp.status >= 400:
+            try:
+                err_body = orjson.loads(body)
+            except orjson.JSONDecodeError:
+                err_body = body.decode("utf-8", errors="replace")
+            response = httpx.Response(
+                resp.status,
+                headers=[(k, v) for k, v in resp.headers.items() if k.lower() not in ("content-encoding", "content-length")],
+                content=body,
+                request=request
+            )
+            raise self.client._make_status_error(f"Error code: {resp.status} - {err_body}", body=err_body, response=response)
+        try:
+            return ChatCompletion.construct(**orjson.loads(body))
+        except (orjson.JSONDecodeError, TypeError) as e:
+            logger.debug(f"直接请求 {url} 的响应无法解析：{e}，改用 OpenAI SDK 请求。")
+            return None
+
+    def _fill_tool_calls(self, llm_response: LLMResponse, tools: FuncCall, tool_calls: List[tuple]):
+        '''
+        将模型返回的工具调用填充到 llm_response。tool_calls 的格式为 [(函数名, 参数 JSON 字符串), ...]
+        '''
+        func_map = tools.get_func_map()
+        calls = [(func_name, arguments) for func_name, arguments in tool_calls if func_name in func_map]
+        args_ls = [orjson.loads(arguments) for _, arguments in calls]
+        func_name_ls = [func_name for func_name, _ in calls]
+        llm_response.role = "tool"
+        llm_response.tools_call_args = args_ls
+        llm_response.tools_call_name = func_name_ls
+
+    async def _query_stream(self, payloads: dict, tools: FuncCall) -> AsyncGenerator[Union[str, LLMResponse], None]:
+        '''
+        以流式请求 LLM。每收到一段文本就 yield 这段文本(str)，最后 yield 组装好的 LLMResponse。
+        工具调用的参数会按照 index 拼接后再解析。LLMResponse 的 raw_completion 为由流拼接成的 ChatCompletion。
+        '''
+        if tools:
+            tool_list = tools.get_func_desc_openai_style_cached()
+            if tool_list:
+                payloads['tools'] = tool_list
+
+        completion = await self.client.chat.completions.create(
+            **payloads,
+            stream=True
+        )
+
+        text_parts = []
+        tool_calls: Dict[int, list] = {}
+        '''key: 工具调用的 index, value: [调用 ID, 函数名, [参数片段, ...]]'''
+        finish_reason = None
+        last_chunk = None
+        async for chunk in completion:
+            last_chunk = chunk
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            delta = choice.delta
+            if not delta:
+                continue
+            if delta.content:
+                text_parts.append(delta.content)
+                yield delta.content
+            if delta.tool_calls:
+                for tool_call in delta.tool_calls:
+                    call = tool_calls.setdefault(tool_call.index, ["", "", []])
+                    if tool_call.id:
+                        call[0] = tool_call.id
+                    if tool_call.function:
+                        if tool_call.function.name:
+                            call[1] += tool_call.function.name
+                        if tool_call.function.arguments:
+                            call[2].append(tool_call.function.arguments)
+
+        if finish_reason == 'content_filter':
+            raise Exception("API 返回的 completion 由于内容安全过滤被拒绝(非 AstrBot)。")
+
+        text = "".join(text_parts)
+        calls = [(call_id, name, "".join(arguments)) for _, (call_id, name, arguments) in sorted(tool_calls.items())]
+
+        llm_response = LLMResponse("assistant")
+        llm_response.completion_text = text.strip()
+        if calls:
+            self._fill_tool_calls(llm_response, tools, [(name, arguments) for _, name, arguments in calls])
+
+        if not llm_response.completion_text and not llm_response.tools_call_args:
+            raise Exception("API 返回的 completion 为空。")
+
+        llm_response.raw_completion = ChatCompletion.construct(
+            id=last_chunk.id,
+            object="chat.completion",
+            created=last_chunk.created,
+            model=last_chunk.model,
+            choices=[Choice.construct(
+                index=0,
+                finish_reason=finish_reason,
+                message=ChatCompletionMessage.construct(
+                    role="assistant",
+                    content=text or None,
+                    tool_calls=[
+                        ChatCompletionMessageToolCall.construct(
+                            id=call_id, type="function", function=Function.construct(name=name, arguments=arguments)
+                        ) for call_id, name, arguments in calls
+                    ] or None
+                )
+            )],
+            usage=getattr(last_chunk, "usage", None)
+        )
+        yield llm_response
+
+    async def _query_streaming(
+        self, 
+        payloads: dict, 
+        tools: FuncCall, 
+        stream_handler: Callable[[str], Awaitable] = None
+    ) -> LLMResponse:
+        '''流式请求 LLM，每收到一段文本就交给 stream_handler 处理，返回最终的 LLMResponse'''
+        llm_response = None
+        async for item in self._query_stream(payloads, tools):
+            if isinstance(item, LLMResponse):
+                llm_response = item
+            elif stream_handler:
+                await stream_handler(item)
+        return llm_response
+
+    async def _query_with_retry(
+        self, 
+        payloads: dict, 
+        tools: FuncCall, 
+        stream: bool = False, 
+        stream_handler: Callable[[str], Awaitable] = None
+    ) -> LLMResponse:
+        '''
+        请求 LLM。遇到限流（429）、服务端错误（5xx）、连接错误或者超时时，按照指数退避加随机抖动重试，优先遵循 Retry-After 响应头。
+        流式请求只在还没有文本交给 stream_handler 时重试，否则重试会导致重复输出。
+        '''
+        emitted = False
+        async def handler(text: str):
+            nonlocal emitted
+            emitted = True
+            await stream_handler(text)
+
+        for attempt in range(RETRY_MAX_ATTEMPTS):
+            self._ensure_available_key()
+            key_idx = self._key_idx
+            try:
+                if stream:
+                    return await self._query_streaming(payloads, tools, handler if stream_handler else None)
+                return await self._query(payloads, tools)
+            except (RateLimitError, InternalServerError, APIConnectionError) as e: # APITimeoutError 是 APIConnectionError 的子类
+                if attempt == RETRY_MAX_ATTEMPTS - 1 or emitted:
+                    raise e
+                if isinstance(e, RateLimitError) and self._rotate_key(key_idx, self._get_retry_after(e)):
+                    logger.warning(f"当前 Key 被限流，已切换到第 {self._key_idx + 1} 个 Key 重试。")
+                    continue
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) + random.uniform(0, RETRY_JITTER)
+                retry_after = self._get_retry_after(e)
+                if retry_after is not None:
+                    delay = min(RETRY_MAX_DELAY, retry_after)
+                logger.warning(f"请求 LLM 失败：{type(e).__name__}，{delay:.2f} 秒后重试({attempt + 1}/{RETRY_MAX_ATTEMPTS - 1})。")
+                await asyncio.sleep(delay)
+
+    def _use_key(self, idx: int):
+        if idx != self._key_idx:
+            self._key_idx = idx
+            self.client = self._shared_client.with_options(api_key=self.api_keys[idx])
+
+    def _next_available_key(self) -> int:
+        '''从当前 Key 开始轮询，返回第一个未被限流的 Key 的下标，没有则返回 None'''
+        now = time.monotonic()
+        for offset in range(len(self.api_keys)):
+            idx = (self._key_idx + offset) % len(self.api_keys)
+            if self._key_available_at[idx] <= now:
+                return idx
+        return None
+
+    def _ensure_available_key(self):
+        '''当前 Key 仍在限流冷却中时，切换到其他可用的 Key'''
+        if len(self.api_keys) < 2:
+            return
+        idx = self._next_available_key()
+        if idx is not None:
+            self._use_key(idx)
+
+    def _rotate_key(self, failed_idx: int, retry_after: float = None) -> bool:
+        '''
+        将被限流的 Key（failed_idx，发起请求时使用的 Key）标记为限流，冷却时间优先使用 Retry-After。
+        如果其他并发请求已经切换到了可用的 Key，直接使用它；否则切换到下一个可用的 Key。可以重试时返回 True。
+        客户端关闭了 SDK 自带的重试，因此第一次收到 429 时就会切换 Key，而不是先在同一个 Key 上等待重试。
+        '''
+        if len(self.api_keys) < 2:
+            return False
+        now = time.monotonic()
+        cooldown = retry_after if retry_after is not None else RETRY_MAX_DELAY
+        self._key_available_at[failed_idx] = now + cooldown
+        if self._key_idx != failed_idx and self._key_available_at[self._key_idx] <= now:
+            return True
+        idx = self._next_available_key()
+        if idx is None:
+            return False
+        self._use_key(idx)
+        return True
+
+    def _get_retry_after(self, e: Exception) -> float:
+        response = getattr(e, "response", None)
+        if response is None:
+            return None
+        try:
+            return float(response.headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
     async def text_chat(
         self,
         prompt: str,
@@ -122,79 +674,86 @@ class ProviderOpenAIOfficial(Provider):
         func_tool: FuncCall=None,
         contexts=[],
         system_prompt=None,
+        stream: bool=False,
+        stream_handler: Callable[[str], Awaitable]=None,
         **kwargs
     ) -> LLMResponse: 
+        '''
+        stream 为 True 时以流式请求 LLM，每收到一段文本就会 await stream_handler(文本)，返回值与非流式一致。
+        '''
         new_record = await self.assemble_context(prompt, image_urls)
-        context_query = [*contexts, new_record]
+        context_query = []
         if system_prompt:
-            context_query.insert(0, {"role": "system", "content": system_prompt})
+            context_query.append({"role": "system", "content": system_prompt})
+        # _no_save 仅用于标记不持久化的记录，不发送给 API。这里不修改原记录，否则保存历史记录时无法再过滤它们
+        context_query.extend(
+            {k: v for k, v in part.items() if k != '_no_save'} if '_no_save' in part else part
+            for part in contexts
+        )
+        context_query.append(new_record)
 
-        for part in context_query:
-            if '_no_save' in part:
-                del part['_no_save']
-                
-                
         model_config = self.provider_config.get("model_config", {})
         model_config['model'] = self.get_model()
 
+        self._start_encoding_load()
+        self._fit_to_window(
+            context_query, 
+            int(model_config.get("max_tokens") or model_config.get("max_completion_tokens") or 0)
+        )
+
         payloads = {
             "messages": context_query,
             **model_config
         }
         llm_response = None
         try:
-            llm_response = await self._query(payloads, func_tool)
+            llm_response = await self._query_with_retry(payloads, func_tool, stream, stream_handler)
         except UnprocessableEntityError as e:
             logger.warning(f"不可处理的实体错误：{e}，尝试删除图片。")
             # 尝试删除所有 image
             new_contexts = await self._remove_image_from_context(context_query)
             payloads['messages'] = new_contexts
             context_query = new_contexts
-            llm_response = await self._query(payloads, func_tool)
+            llm_response = await self._query_with_retry(payloads, func_tool, stream, stream_handler)
         except Exception as e:
-            if "maximum context length" in str(e):
+            msg = str(e)
+            low = msg.lower()
+            if _is_context_length_exceeded(e, low):
                 # 重试 10 次
                 retry_cnt = 20
                 while retry_cnt > 0:
                     logger.warning(f"上下文长度超过限制。尝试弹出最早的记录然后重试。当前记录条数: {len(context_query)}")
                     try:
                         await self.pop_record(context_query)
-                        llm_response = await self._query(payloads, func_tool)
+                        llm_response = await self._query_with_retry(payloads, func_tool, stream, stream_handler)
                         break
                     except Exception as e:
-                        if "maximum context length" in str(e):
+                        if _is_context_length_exceeded(e, str(e).lower()):
                             retry_cnt -= 1
                         else:
                             raise e
                 if retry_cnt == 0:
                     llm_response = LLMResponse("err", "err: 请尝试 /reset 清除会话记录。")
-            elif "The model is not a VLM" in str(e): # siliconcloud
+            elif "The model is not a VLM" in msg: # siliconcloud
                 # 尝试删除所有 image
                 new_contexts = await self._remove_image_from_context(context_query)
                 payloads['messages'] = new_contexts
-                llm_response = await self._query(payloads, func_tool)
+                llm_response = await self._query_with_retry(payloads, func_tool, stream, stream_handler)
 
             # openai, ollama, gemini openai, siliconcloud 的错误提示与 code 不统一，只能通过字符串匹配
-            elif 'does not support Function Calling' in str(e) \
-                or 'does not support tools' in str(e)  \
-                or 'Function call is not supported' in str(e) \
-                or 'Function calling is not enabled' in str(e) \
-                or 'Tool calling is not supported' in str(e) \
-                or 'No endpoints found that support tool use' in str(e) \
-                or 'model does not support function calling' in str(e) \
-                or ('tool' in str(e) and 'support' in str(e).lower()) \
-                or ('function' in str(e) and 'support' in str(e).lower()):
+            elif _FC_UNSUPPORTED.search(msg) \
+                or (('tool' in msg or 'function' in msg) and 'support' in low):
                     logger.info(f"{self.get_model()} 不支持函数工具调用，已自动去除，不影响使用。")
                     if 'tools' in payloads:
                         del payloads['tools']
-                    llm_response = await self._query(payloads, None)
+                    llm_response = await self._query_with_retry(payloads, None, stream, stream_handler)
             else:
                 logger.error(f"发生了错误。Provider 配置如下: {self.provider_config}")
                 
-                if 'tool' in str(e).lower() and 'support' in str(e).lower():
+                if 'tool' in low and 'support' in low:
                     logger.error("疑似该模型不支持函数调用工具调用。请输入 /tool off_all")
                 
-                if 'Connection error.' in str(e):
+                if isinstance(e, APIConnectionError) or 'Connection error.' in msg:
                     proxy = os.environ.get("http_proxy", None)
                     if proxy:
                         logger.error(f"可能为代理原因，请检查代理是否正常。当前代理: {proxy}")
@@ -236,7 +795,9 @@ class ProviderOpenAIOfficial(Provider):
         return self.api_keys
     
     def set_key(self, key):
-        self.client.api_key = key
+        if key in self.api_keys:
+            self._key_idx = self.api_keys.index(key)
+        self.client = self._shared_client.with_options(api_key=key)
         
     async def assemble_context(self, text: str, image_urls: List[str] = None):
         '''
@@ -244,15 +805,9 @@ class ProviderOpenAIOfficial(Provider):
         '''
         if image_urls:
             user_content = {"role": "user","content": [{"type": "text", "text": text}]}
-            for image_url in image_urls:
-                if image_url.startswith("http"):
-                    image_path = await download_image_by_url(image_url)
-                    image_data = await self.encode_image_bs64(image_path)
-                elif image_url.startswith("file:///"):
-                    image_path = image_url.replace("file:///", "")
-                    image_data = await self.encode_image_bs64(image_path)
-                else:
-                    image_data = await self.encode_image_bs64(image_url)
+            # 并发下载、编码所有图片
+            images_data = await asyncio.gather(*[self._load_image(image_url) for image_url in image_urls])
+            for image_url, image_data in zip(image_urls, images_data):
                 if not image_data:
                     logger.warning(f"图片 {image_url} 得到的结果为空，将忽略。")
                     continue
@@ -261,13 +816,36 @@ class ProviderOpenAIOfficial(Provider):
         else:
             return {"role": "user","content": text}
 
+    async def _load_image(self, image_url: str) -> str:
+        '''
+        获取图片（URL 会先下载到本地）并转换为 base64 data url
+        '''
+        if image_url.startswith("http"):
+            image_path = _image_cache.get_path(image_url)
+            if not image_path:
+                image_path = await download_image_by_url(image_url)
+                _image_cache.put_path(image_url, image_path)
+            return await self.encode_image_bs64(image_path)
+        return await self.encode_image_bs64(image_url)
+
     async def encode_image_bs64(self, image_url: str) -> str:
         '''
-        将图片转换为 base64
+        将图片转换为 base64。支持 base64://、file:/// 和本地路径
         '''
-        if image_url.startswith("base64://"):
-            return image_url.replace("base64://", "data:image/jpeg;base64,")
-        with open(image_url, "rb") as f:
-            image_bs64 = base64.b64encode(f.read()).decode('utf-8')
-            return "data:image/jpeg;base64," + image_bs64
-        return ''
\ No newline at end of file
+        if image_url.startswith(PREFIX_B64):
+            image_bs64 = image_url[len(PREFIX_B64):]
+            try:
+                mime = _guess_image_mime(base64.b64decode(image_bs64[:16]))
+            except ValueError:
+                mime = "image/jpeg"
+            return f"data:{mime};base64," + image_bs64
+        if image_url.startswith(PREFIX_FILE):
+            image_url = image_url[len(PREFIX_FILE):]
+        stat = os.stat(image_url)
+        cache_key = (image_url, stat.st_mtime, stat.st_size)
+        cached = _image_cache.get_data(cache_key)
+        if cached:
+            return cached
+        data = await asyncio.to_thread(_read_and_b64, image_url)
+        _image_cache.put_data(cache_key, data)
+        return data
\ No newline at end of file
@@ -58,21 +58,21 @@ class ProviderZhipu(ProviderOpenAIOfficial):
             **model_cfgs
         }
         try:
-            llm_response = await self._query(payloads, func_tool)
+            llm_response = await self._query_with_retry(payloads, func_tool)
             return llm_response
         except Exception as e:
             if "maximum context length" in str(e):
                 retry_cnt = 10
                 while retry_cnt > 0:
-                    logger.warning(f"请求失败：{e}。上下文长度超过限制。尝试弹出最早的记录然后重试。")
+                    logger.warning(f"上下文长度超过限制。尝试弹出最早的记录然后重试。当前记录条数: {len(context_query)}")
                     try:
-                        self.pop_record(session_id)
-                        llm_response = await self._query(payloads, func_tool)
-                        break
+                        await self.pop_record(context_query)
+                        return await self._query_with_retry(payloads, func_tool)
                     except Exception as e:
                         if "maximum context length" in str(e):
                             retry_cnt -= 1
                         else:
                             raise e
+                return LLMResponse("err", "err: 请尝试 /reset 清除会话记录。")
             else:
                 raise e
\ No newline at end of file
@@ -0,0 +1,73 @@
+import time
+import uuid
+import pytest
+import orjson
+from astrbot.core.conversation_mgr import ConversationManager
+from astrbot.core.db.sqlite import SQLiteDatabase
+
+UMO = "test_platform:FriendMessage:test_conv_mgr"
+HISTORY = [{"role": "user", "content": "ping"}, {"role": "assistant", "content": "pong"}]
+
+
+@pytest.fixture
+def db(tmp_path):
+    return SQLiteDatabase(str(tmp_path / "data_v3.db"))
+
+
+@pytest.fixture
+def cid(db: SQLiteDatabase):
+    cid = str(uuid.uuid4())
+    db.new_conversation(user_id=UMO, cid=cid)
+    return cid
+
+
+@pytest.mark.asyncio
+async def test_read_after_update(db: SQLiteDatabase, cid: str):
+    conv_mgr = ConversationManager(db)
+    conv_mgr.history_flush_delay = 60
+    await conv_mgr.update_conversation(UMO, cid, HISTORY)
+    # 尚未写入数据库
+    assert orjson.loads(db.get_conversation_by_user_id(UMO, cid).history) == []
+    conversation = await conv_mgr.get_conversation(UMO, cid)
+    assert orjson.loads(conversation.history) == HISTORY
+
+
+@pytest.mark.asyncio
+async def test_updates_are_merged(db: SQLiteDatabase, cid: str):
+    conv_mgr = ConversationManager(db)
+    conv_mgr.history_flush_delay = 0.05
+    writes = []
+    update_conversation = db.update_conversation
+    def spy(**kwargs):
+        writes.append(kwargs["history"])
+        update_conversation(**kwargs)
+    db.update_conversation = spy
+    await conv_mgr.update_conversation(UMO, cid, HISTORY[:1])
+    await conv_mgr.update_conversation(UMO, cid, HISTORY)
+    await conv_mgr._flush_task
+    assert [orjson.loads(history) for history in writes] == [HISTORY]
+
+
+@pytest.mark.asyncio
+async def test_delete_drops_pending_write(db: SQLiteDatabase, cid: str):
+    conv_mgr = ConversationManager(db)
+    conv_mgr.history_flush_delay = 60
+    conv_mgr.session_conversations[UMO] = cid
+    writes = []
+    db.update_conversation = lambda **kwargs: writes.append(kwargs)
+    await conv_mgr.update_conversation(UMO, cid, HISTORY)
+    await conv_mgr.delete_conversation(UMO, cid)
+    await conv_mgr.flush()
+    assert writes == []
+    assert db.get_conversation_by_user_id(UMO, cid) is None
+
+
+@pytest.mark.asyncio
+async def test_flush_writes_immediately(db: SQLiteDatabase, cid: str):
+    conv_mgr = ConversationManager(db)
+    conv_mgr.history_flush_delay = 60
+    await conv_mgr.update_conversation(UMO, cid, HISTORY)
+    start = time.monotonic()
+    await conv_mgr.flush()
+    assert time.monotonic() - start < 5
+    assert orjson.loads(db.get_conversation_by_user_id(UMO, cid).history) == HISTORY
@@ -0,0 +1,61 @@
+import pytest
+from astrbot.core.pipeline.process_stage.method.llm_request import LLMRequestSubStage
+
+PRESET = [
+    {"role": "user", "content": "preset user", "_no_save": None},
+    {"role": "assistant", "content": "preset assistant", "_no_save": None},
+]
+
+
+def make_stage(max_context_length: int) -> LLMRequestSubStage:
+    # 跳过 initialize，只设置 _truncate_contexts 用到的配置
+    stage = LLMRequestSubStage.__new__(LLMRequestSubStage)
+    stage.max_context_length = max_context_length
+    return stage
+
+
+def make_history(rounds: int) -> list:
+    history = []
+    for i in range(rounds):
+        history.append({"role": "user", "content": f"u{i}"})
+        history.append({"role": "assistant", "content": f"a{i}"})
+    return history
+
+
+@pytest.mark.parametrize("max_context_length", [-1, 0])
+def test_truncate_disabled(max_context_length):
+    contexts = PRESET + make_history(5)
+    assert make_stage(max_context_length)._truncate_contexts(contexts) is contexts
+
+
+def test_truncate_empty():
+    assert make_stage(2)._truncate_contexts([]) == []
+
+
+def test_truncate_keeps_recent_rounds():
+    contexts = make_history(5)
+    truncated = make_stage(2)._truncate_contexts(contexts)
+    assert [c["content"] for c in truncated] == ["u3", "a3", "u4", "a4"]
+    # 不修改原来的记录
+    assert len(contexts) == 10
+
+
+def test_truncate_short_history():
+    contexts = PRESET + make_history(2)
+    assert make_stage(2)._truncate_contexts(contexts) is contexts
+
+
+def test_truncate_keeps_persona_preset():
+    contexts = PRESET + make_history(5)
+    truncated = make_stage(1)._truncate_contexts(contexts)
+    assert [c["content"] for c in truncated] == ["preset user", "preset assistant", "u4", "a4"]
+
+
+def test_truncate_only_leading_preset_is_kept():
+    # 只有开头连续的 _no_save 记录算作人格预设
+    contexts = make_history(2) + [
+        {"role": "user", "content": "late", "_no_save": None},
+        {"role": "assistant", "content": "reply"},
+    ]
+    truncated = make_stage(1)._truncate_contexts(contexts)
+    assert [c["content"] for c in truncated] == ["late", "reply"]
@@ -0,0 +1,440 @@
+import time
+import asyncio
+import pytest
+import orjson
+from aiohttp import web
+from openai import RateLimitError, APIConnectionError, APITimeoutError, BadRequestError
+from astrbot.core.provider.sources import openai_source
+from astrbot.core.provider.sources.openai_source import ProviderOpenAIOfficial
+
+
+class FakeEncoding():
+    '''每个字符计为一个 token'''
+    def encode_batch(self, texts, disallowed_special="all"):
+        return [list(text) for text in texts]
+
+
+def make_provider(provider_config: dict = None) -> ProviderOpenAIOfficial:
+    # 跳过 __init__，不创建客户端，也不加载 tiktoken 编码
+    provider = ProviderOpenAIOfficial.__new__(ProviderOpenAIOfficial)
+    provider.provider_config = provider_config or {}
+    return provider
+
+
+@pytest.mark.parametrize("model_name, context_window", [
+    ("gpt-4", 8192),
+    ("gpt-4-0613", 8192),
+    ("gpt-4-32k", 32768),
+    ("gpt-4-turbo", 128000),
+    ("gpt-4-turbo-2024-04-09", 128000),
+    ("gpt-4-0125-preview", 128000),
+    ("gpt-4o", 128000),
+    ("gpt-4o-mini", 128000),
+    ("gpt-4.1", 1047576),
+    ("gpt-4.1-mini", 1047576),
+    ("gpt-4.5-preview", 128000),
+    ("gpt-3.5-turbo-0125", 16385),
+    ("o1", 200000),
+    ("o1-mini", 128000),
+    ("o1-2024-12-17", 200000),
+    ("o3-mini", 200000),
+    ("gpt-4-unknown-model", 0),
+    ("glm-4-flash", 0),
+])
+def test_get_context_window(model_name, context_window):
+    assert make_provider()._get_context_window(model_name) == context_window
+
+
+def test_get_context_window_from_config():
+    provider = make_provider({"context_window": "4096"})
+    assert provider._get_context_window("gpt-4o") == 4096
+
+
+def make_window_provider(context_window: int) -> ProviderOpenAIOfficial:
+    provider = make_provider()
+    provider._context_window = context_window
+    provider._encoding = FakeEncoding()
+    return provider
+
+
+def test_fit_to_window_pops_pairs():
+    # 每条记录 10 + 4 = 14 个 token
+    messages = [
+        {"role": "system", "content": "s" * 10},
+        {"role": "user", "content": "a" * 10},
+        {"role": "assistant", "content": "b" * 10},
+        {"role": "user", "content": "c" * 10},
+        {"role": "assistant", "content": "d" * 10},
+        {"role": "user", "content": "e" * 10},
+    ]
+    provider = make_window_provider(14 * 4)
+    provider._fit_to_window(messages)
+    assert [m["content"][0] for m in messages] == ["s", "c", "d", "e"]
+
+
+def test_fit_to_window_keeps_system_and_last_message():
+    messages = [
+        {"role": "system", "content": "s" * 10},
+        {"role": "user", "content": "a" * 10},
+        {"role": "assistant", "content": "b" * 10},
+        {"role": "user", "content": "c" * 100},
+    ]
+    provider = make_window_provider(20)
+    provider._fit_to_window(messages)
+    assert [m["content"][0] for m in messages] == ["s", "c"]
+
+
+def test_fit_to_window_reserves_completion_tokens():
+    messages = [
+        {"role": "user", "content": "a" * 10},
+        {"role": "assistant", "content": "b" * 10},
+        {"role": "user", "content": "c" * 10},
+    ]
+    provider = make_window_provider(14 * 3)
+    provider._fit_to_window(messages)
+    assert len(messages) == 3
+    provider._fit_to_window(messages, max_completion_tokens=10)
+    assert [m["content"][0] for m in messages] == ["c"]
+
+
+def test_fit_to_window_counts_text_parts():
+    messages = [
+        {"role": "user", "content": [{"type": "text", "text": "a" * 10}, {"type": "image_url", "image_url": {}}]},
+        {"role": "assistant", "content": "b" * 10},
+        {"role": "user", "content": "c" * 10},
+    ]
+    provider = make_window_provider(14 * 3)
+    provider._fit_to_window(messages)
+    assert len(messages) == 3
+
+
+def test_fit_to_window_unknown_window():
+    messages = [{"role": "user", "content": "a" * 10}] * 3
+    provider = make_window_provider(0)
+    provider._fit_to_window(messages)
+    assert len(messages) == 3
+
+
+def test_fit_to_window_special_tokens():
+    tiktoken = pytest.importorskip("tiktoken")
+    # 只包含单字节词表和一个特殊 token 的真实 tiktoken 编码，不需要联网下载
+    encoding = tiktoken.Encoding(
+        name="test_bytes",
+        pat_str=r"\S+|\s+",
+        mergeable_ranks={bytes([i]): i for i in range(256)},
+        special_tokens={"<|endoftext|>": 256},
+    )
+    with pytest.raises(ValueError):
+        encoding.encode_batch(["<|endoftext|>"])
+    messages = [
+        {"role": "user", "content": "<|endoftext|>" + "a" * 10},
+        {"role": "assistant", "content": "b" * 10},
+        {"role": "user", "content": "c" * 10},
+    ]
+    provider = make_window_provider(30)
+    provider._encoding = encoding
+    provider._fit_to_window(messages)
+    assert [m["content"][-1] for m in messages] == ["c"]
+
+
+def test_fit_to_window_count_error():
+    class BrokenEncoding():
+        def encode_batch(self, texts, disallowed_special="all"):
+            raise ValueError("broken")
+    messages = [{"role": "user", "content": "a" * 10}] * 3
+    provider = make_window_provider(1)
+    provider._encoding = BrokenEncoding()
+    provider._fit_to_window(messages)
+    assert len(messages) == 3
+
+
+COMPLETION = {
+    "id": "1", "object": "chat.completion", "created": 0, "model": "m",
+    "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "pong"}}],
+}
+
+
+async def start_server(handler):
+    '''启动一个本地的 /v1/chat/completions 服务，返回 (runner, api_base)'''
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}/v1"
+
+
+def make_real_provider(api_base: str, keys=None, **config) -> ProviderOpenAIOfficial:
+    return ProviderOpenAIOfficial({
+        "id": "test", "type": "openai_chat_completion", "key": keys or ["k1"],
+        "api_base": api_base, "http_backend": "httpx", "model_config": {"model": "m"},
+        **config
+    }, {}, None)
+
+
+@pytest.mark.asyncio
+async def test_single_retry_layer(monkeypatch):
+    monkeypatch.setattr(openai_source, "RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(openai_source, "RETRY_JITTER", 0)
+    hits = []
+    async def handler(request):
+        hits.append(request.headers["Authorization"])
+        return web.json_response({"error": {"message": "rate limited"}}, status=429)
+    runner, api_base = await start_server(handler)
+    provider = make_real_provider(api_base)
+    try:
+        assert provider.client.max_retries == 0
+        with pytest.raises(RateLimitError):
+            await provider.text_chat("ping")
+        assert len(hits) == openai_source.RETRY_MAX_ATTEMPTS
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_retry_server_error(monkeypatch):
+    monkeypatch.setattr(openai_source, "RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(openai_source, "RETRY_JITTER", 0)
+    hits = []
+    async def handler(request):
+        hits.append(1)
+        if len(hits) == 1:
+            return web.json_response({"error": {"message": "bad gateway"}}, status=502)
+        return web.json_response(COMPLETION)
+    runner, api_base = await start_server(handler)
+    provider = make_real_provider(api_base)
+    try:
+        assert (await provider.text_chat("ping")).completion_text == "pong"
+        assert len(hits) == 2
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
+
+
+async def sse_handler(request):
+    chunks = [
+        {"choices": [{"index": 0, "delta": {"role": "assistant", "content": "po"}}]},
+        {"choices": [{"index": 0, "delta": {"content": "ng"}, "finish_reason": "stop"}]},
+    ]
+    resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await resp.prepare(request)
+    for chunk in chunks:
+        chunk.update({"id": "1", "object": "chat.completion.chunk", "created": 0, "model": "m"})
+        await resp.write(b"data: " + orjson.dumps(chunk) + b"\n\n")
+    await resp.write(b"data: [DONE]\n\n")
+    return resp
+
+
+@pytest.mark.asyncio
+async def test_stream_sets_raw_completion():
+    runner, api_base = await start_server(sse_handler)
+    provider = make_real_provider(api_base)
+    deltas = []
+    async def stream_handler(text):
+        deltas.append(text)
+    try:
+        llm_response = await provider.text_chat("ping", stream=True, stream_handler=stream_handler)
+        assert deltas == ["po", "ng"]
+        assert llm_response.completion_text == "pong"
+        assert llm_response.raw_completion.choices[0].message.content == "pong"
+        assert llm_response.raw_completion.choices[0].finish_reason == "stop"
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_stream_not_retried_after_first_delta(monkeypatch):
+    monkeypatch.setattr(openai_source, "RETRY_BASE_DELAY", 0)
+    monkeypatch.setattr(openai_source, "RETRY_JITTER", 0)
+    provider = make_real_provider("http://127.0.0.1:1/v1")
+    attempts = []
+    async def broken_stream(payloads, tools):
+        attempts.append(1)
+        if len(attempts) > 1:
+            yield "po"
+        raise APIConnectionError(request=None)
+    monkeypatch.setattr(provider, "_query_stream", broken_stream)
+    deltas = []
+    async def stream_handler(text):
+        deltas.append(text)
+    try:
+        with pytest.raises(APIConnectionError):
+            await provider._query_with_retry({}, None, stream=True, stream_handler=stream_handler)
+        # 第一次失败时还没有输出，可以重试；第二次已经输出了文本，不再重试
+        assert len(attempts) == 2
+        assert deltas == ["po"]
+    finally:
+        await provider.terminate()
+
+
+@pytest.mark.asyncio
+async def test_encoding_loaded_in_background(monkeypatch):
+    monkeypatch.setattr(openai_source, "_ENCODING_CACHE", {})
+    provider = make_real_provider("http://127.0.0.1:1/v1", model_config={"model": "gpt-4o"})
+    def slow_load(model_name):
+        time.sleep(0.2)
+        return FakeEncoding()
+    monkeypatch.setattr(provider, "_load_encoding", slow_load)
+    try:
+        assert provider._encoding is None
+        start = time.monotonic()
+        provider._start_encoding_load()
+        # 不等待加载完成
+        assert time.monotonic() - start < 0.1
+        assert provider._encoding is None
+        await provider._encoding_task
+        assert isinstance(provider._encoding, FakeEncoding)
+    finally:
+        await provider.terminate()
+
+
+@pytest.mark.asyncio
+async def test_direct_http(monkeypatch):
+    monkeypatch.setattr(openai_source, "RETRY_MAX_ATTEMPTS", 1)
+    hits = []
+    async def handler(request):
+        prompt = (await request.json())["messages"][-1]["content"]
+        hits.append(prompt)
+        if prompt == "rate":
+            return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"retry-after": "3"})
+        if prompt == "long":
+            return web.json_response({"error": {
+                "message": "This model's maximum context length is 8192 tokens.", "code": "context_length_exceeded"
+            }}, status=400)
+        if prompt == "slow":
+            await asyncio.sleep(2)
+        return web.json_response(COMPLETION)
+    runner, api_base = await start_server(handler)
+    provider = make_real_provider(api_base, direct_http=True, timeout=1)
+    try:
+        assert (await provider.text_chat("ping")).completion_text == "pong"
+
+        # 错误响应直接抛出 SDK 的异常，不再经过 SDK 重新请求
+        with pytest.raises(RateLimitError) as exc_info:
+            await provider._query({"model": "m", "messages": [{"role": "user", "content": "rate"}]}, None)
+        assert provider._get_retry_after(exc_info.value) == 3
+
+        with pytest.raises(BadRequestError) as exc_info:
+            await provider._query({"model": "m", "messages": [{"role": "user", "content": "long"}]}, None)
+        assert exc_info.value.code == "context_length_exceeded"
+
+        with pytest.raises(APITimeoutError):
+            await provider.text_chat("slow")
+
+        assert hits == ["ping", "rate", "long", "slow"]
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_direct_http_sdk_only_params():
+    bodies = []
+    async def handler(request):
+        bodies.append(await request.json())
+        return web.json_response(COMPLETION)
+    runner, api_base = await start_server(handler)
+    provider = make_real_provider(api_base, direct_http=True, model_config={"model": "m", "extra_body": {"top_k": 1}})
+    try:
+        assert (await provider.text_chat("ping")).completion_text == "pong"
+        # 由 SDK 请求，extra_body 被合并到请求体中
+        assert bodies[0]["top_k"] == 1
+        assert "extra_body" not in bodies[0]
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
+
+
+@pytest.mark.asyncio
+async def test_rotate_key_on_rate_limit():
+    hits = []
+    async def handler(request):
+        key = request.headers["Authorization"]
+        hits.append(key)
+        if key == "Bearer k1":
+            return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"retry-after": "30"})
+        return web.json_response(COMPLETION)
+    runner, api_base = await start_server(handler)
+    provider = make_real_provider(api_base, keys=["k1", "k2"])
+    try:
+        start = time.monotonic()
+        assert (await provider.text_chat("ping")).completion_text == "pong"
+        assert time.monotonic() - start < 5
+        assert provider.get_current_key() == "k2"
+        # k1 在冷却中，下一次请求直接使用 k2
+        assert (await provider.text_chat("ping")).completion_text == "pong"
+        assert hits == ["Bearer k1", "Bearer k2", "Bearer k2"]
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
+
+
+def test_image_cache_evicts_by_bytes():
+    cache = openai_source._ImageCache(max_bytes=10)
+    cache.put_data(("a",), "1234")
+    cache.put_data(("b",), "1234")
+    # 访问 a，使 b 成为最久未使用的记录
+    assert cache.get_data(("a",)) == "1234"
+    cache.put_data(("c",), "1234")
+    assert cache.get_data(("b",)) is None
+    assert cache.get_data(("a",)) == "1234"
+    assert cache.get_data(("c",)) == "1234"
+    assert cache._bytes == 8
+
+
+def test_image_cache_replace_and_oversized():
+    cache = openai_source._ImageCache(max_bytes=10)
+    cache.put_data(("a",), "1234")
+    cache.put_data(("a",), "123456")
+    assert cache._bytes == 6
+    # 超过总预算的数据不缓存，也不会挤掉已有的记录
+    cache.put_data(("b",), "x" * 11)
+    assert cache.get_data(("b",)) is None
+    assert cache.get_data(("a",)) == "123456"
+
+
+def test_image_cache_paths(tmp_path):
+    cache = openai_source._ImageCache(max_urls=2)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"{i}.jpg"
+        path.write_bytes(b"")
+        paths.append(str(path))
+        cache.put_path(f"http://example.com/{i}.jpg", str(path))
+    assert cache.get_path("http://example.com/0.jpg") is None
+    assert cache.get_path("http://example.com/1.jpg") == paths[1]
+    # 临时文件被清理后不再返回
+    (tmp_path / "2.jpg").unlink()
+    assert cache.get_path("http://example.com/2.jpg") is None
+    assert "http://example.com/2.jpg" not in cache._url_paths
+
+
+@pytest.mark.asyncio
+async def test_rotate_key_concurrent():
+    hits = []
+    async def handler(request):
+        key = request.headers["Authorization"]
+        hits.append(key)
+        if key == "Bearer k1":
+            # 让并发的请求都在 k1 上失败
+            await asyncio.sleep(0.05)
+            return web.json_response({"error": {"message": "rate limited"}}, status=429, headers={"retry-after": "30"})
+        return web.json_response(COMPLETION)
+    runner, api_base = await start_server(handler)
+    provider = make_real_provider(api_base, keys=["k1", "k2"])
+    try:
+        start = time.monotonic()
+        responses = await asyncio.gather(*[provider.text_chat("ping") for _ in range(3)])
+        assert time.monotonic() - start < 5
+        assert [r.completion_text for r in responses] == ["pong"] * 3
+        # 只有 k1 进入冷却
+        assert hits.count("Bearer k1") == 3
+        assert hits.count("Bearer k2") == 3
+        assert provider._key_available_at[1] == 0
+    finally:
+        await provider.terminate()
+        await runner.cleanup()
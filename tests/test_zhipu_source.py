@@ -0,0 +1,45 @@
+import pytest
+from astrbot.core.provider.entites import LLMResponse
+from astrbot.core.provider.sources.zhipu_source import ProviderZhipu
+
+HISTORY = [
+    {"role": "user", "content": "u0"},
+    {"role": "assistant", "content": "a0"},
+    {"role": "user", "content": "u1"},
+    {"role": "assistant", "content": "a1"},
+]
+
+
+def make_provider(monkeypatch, max_messages: int):
+    '''消息条数超过 max_messages 时模拟上下文超限'''
+    provider = ProviderZhipu({
+        "id": "test", "type": "zhipu_chat_completion", "key": ["k1"],
+        "api_base": "http://127.0.0.1:1/v1", "http_backend": "httpx", "model_config": {"model": "glm-4-flash"},
+    }, {}, None)
+    async def query(payloads, tools):
+        if len(payloads["messages"]) > max_messages:
+            raise Exception("This model's maximum context length is 8192 tokens.")
+        return LLMResponse("assistant", "pong")
+    monkeypatch.setattr(provider, "_query_with_retry", query)
+    return provider
+
+
+@pytest.mark.asyncio
+async def test_context_overflow_retry_returns_response(monkeypatch):
+    provider = make_provider(monkeypatch, 3)
+    try:
+        llm_response = await provider.text_chat("ping", contexts=[*HISTORY])
+        assert llm_response.role == "assistant"
+        assert llm_response.completion_text == "pong"
+    finally:
+        await provider.terminate()
+
+
+@pytest.mark.asyncio
+async def test_context_overflow_retry_exhausted(monkeypatch):
+    provider = make_provider(monkeypatch, -1)
+    try:
+        llm_response = await provider.text_chat("ping", contexts=[*HISTORY])
+        assert llm_response.role == "err"
+    finally:
+        await provider.terminate()